@@ -0,0 +1,351 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+# --------------------------------------------------------
+
+import functools
+from typing import Tuple
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None  # Don't fail if triton is not installed. We fall back to pytorch ops.
+
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    numba = None  # Same for numba, which is only used for merging on cpu.
+
+HAS_TRITON = triton is not None
+HAS_NUMBA = numba is not None
+
+
+@functools.lru_cache(maxsize=None)
+def half_dtype(device: torch.device) -> torch.dtype:
+    """The 16 bit float type to use for similarity scores: bfloat16 on ampere and newer, float16 before."""
+    return torch.bfloat16 if torch.cuda.get_device_capability(device)[0] >= 8 else torch.float16
+
+
+if HAS_TRITON:
+
+    @triton.jit
+    def _bipartite_max_kernel(
+        metric_ptr,
+        max_ptr,
+        idx_ptr,
+        M,
+        N,
+        K,
+        stride_mb,
+        stride_mt,
+        stride_mc,
+        stride_ob,
+        stride_om,
+        A_OFF,
+        B_OFF,
+        BLOCK_M: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+        BLOCK_K: tl.constexpr,
+        HALF_DOT: tl.constexpr,
+        USE_BF16: tl.constexpr,
+    ):
+        pid_m = tl.program_id(0)
+        pid_b = tl.program_id(1)
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_k = tl.arange(0, BLOCK_K)
+        m_mask = offs_m < M
+
+        # Set a is the even tokens, set b the odd tokens, each without their first *_OFF tokens.
+        # Read both straight out of metric.
+        base = metric_ptr + pid_b * stride_mb
+        a_rows = base + (2 * (offs_m + A_OFF))[:, None] * stride_mt
+
+        # The norm of a doesn't change which b is the best match, so it's only applied at the end
+        a_sq = tl.zeros((BLOCK_M,), dtype=tl.float32)
+        for k in range(0, K, BLOCK_K):
+            k_mask = (k + offs_k) < K
+            a = tl.load(
+                a_rows + (k + offs_k)[None, :] * stride_mc,
+                mask=m_mask[:, None] & k_mask[None, :],
+                other=0.0,
+            ).to(tl.float32)
+            a_sq += tl.sum(a * a, axis=1)
+
+        best = tl.full((BLOCK_M,), float("-inf"), dtype=tl.float32)
+        best_idx = tl.zeros((BLOCK_M,), dtype=tl.int32)
+
+        for n in range(0, N, BLOCK_N):
+            offs_n = n + tl.arange(0, BLOCK_N)
+            n_mask = offs_n < N
+            b_rows = base + (2 * (offs_n + B_OFF) + 1)[:, None] * stride_mt
+
+            acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+            b_sq = tl.zeros((BLOCK_N,), dtype=tl.float32)
+
+            for k in range(0, K, BLOCK_K):
+                k_mask = (k + offs_k) < K
+                a = tl.load(
+                    a_rows + (k + offs_k)[None, :] * stride_mc,
+                    mask=m_mask[:, None] & k_mask[None, :],
+                    other=0.0,
+                )
+                b = tl.load(
+                    b_rows + (k + offs_k)[None, :] * stride_mc,
+                    mask=n_mask[:, None] & k_mask[None, :],
+                    other=0.0,
+                )
+
+                b_f32 = b.to(tl.float32)
+                b_sq += tl.sum(b_f32 * b_f32, axis=1)
+
+                # Run the dot on tensor cores in 16 bit. It still accumulates in fp32, as do the norms.
+                if HALF_DOT:
+                    if USE_BF16:
+                        a = a.to(tl.bfloat16)
+                        b = b.to(tl.bfloat16)
+                    else:
+                        a = a.to(tl.float16)
+                        b = b.to(tl.float16)
+                acc += tl.dot(a, tl.trans(b))
+
+            scores = acc * (1.0 / tl.sqrt(b_sq))[None, :]
+
+            scores = tl.where(n_mask[None, :], scores, float("-inf"))
+
+            tile_max = tl.max(scores, axis=1)
+            tile_idx = tl.argmax(scores, axis=1)
+
+            better = tile_max > best
+            best_idx = tl.where(better, tile_idx + n, best_idx)
+            best = tl.where(better, tile_max, best)
+
+        # Normalizing the dot product is the same as normalizing the rows beforehand
+        best = best * (1.0 / tl.sqrt(a_sq))
+
+        out_offs = pid_b * stride_ob + offs_m * stride_om
+        tl.store(max_ptr + out_offs, best, mask=m_mask)
+        tl.store(idx_ptr + out_offs, best_idx.to(tl.int64), mask=m_mask)
+
+
+def fused_bipartite_max(
+    metric: torch.Tensor, a_off: int = 0, b_off: int = 0
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Finds the most similar odd token for every even token of metric in one kernel.
+    Equivalent to normalizing metric, taking scores = a @ b.transpose(-1, -2) for
+    a, b = metric[..., ::2, :], metric[..., 1::2, :], and then scores.max(dim=-1),
+    but neither the normalized metric nor the scores are ever written out.
+
+    Input size is [batch, tokens, channels]. Requires triton and a cuda tensor.
+    The first a_off even and b_off odd tokens are left out (e.g., for class and distillation tokens).
+    The dot products run in 16 bit with fp32 accumulation, since the scores are only compared.
+
+    Returns the max scores (fp32) and their indices into the remaining odd tokens,
+    both of size [batch, (tokens + 1) // 2 - a_off].
+    """
+    B, T, C = metric.shape
+    M, N = (T + 1) // 2 - a_off, T // 2 - b_off
+
+    dtype = metric.dtype
+    if dtype not in (torch.float16, torch.bfloat16):
+        dtype = half_dtype(metric.device)
+
+    node_max = torch.empty(B, M, device=metric.device, dtype=torch.float32)
+    node_idx = torch.empty(B, M, device=metric.device, dtype=torch.long)
+
+    BLOCK_M, BLOCK_N = 64, 64
+    BLOCK_K = min(max(triton.next_power_of_2(C), 16), 64)
+    grid = (triton.cdiv(M, BLOCK_M), B)
+
+    _bipartite_max_kernel[grid](
+        metric,
+        node_max,
+        node_idx,
+        M,
+        N,
+        C,
+        metric.stride(0),
+        metric.stride(1),
+        metric.stride(2),
+        node_max.stride(0),
+        node_max.stride(1),
+        a_off,
+        b_off,
+        BLOCK_M=BLOCK_M,
+        BLOCK_N=BLOCK_N,
+        BLOCK_K=BLOCK_K,
+        HALF_DOT=metric.dtype != dtype,
+        USE_BF16=dtype == torch.bfloat16,
+    )
+
+    return node_max, node_idx
+
+
+_CPU_MERGE_MODES = {"sum": 0, "mean": 1, "amax": 2}
+_CPU_MERGE_DTYPES = (torch.float32, torch.float64)
+
+
+if HAS_NUMBA:
+
+    @numba.njit(cache=True)
+    def _output_rows(num_unm, t2, distill_token):
+        # Output rows follow the same order as the concatenation in bipartite_soft_matching
+        unm_rows = np.arange(num_unm)
+        dst_rows = np.arange(num_unm, num_unm + t2)
+        if distill_token:
+            unm_rows[1:] += 1
+            dst_rows[0] = 1
+        return unm_rows, dst_rows
+
+    @numba.njit(parallel=True, cache=True)
+    def _bipartite_merge_cpu(x, unm_pos, src_pos, dst_idx, mode, distill_token):
+        n, t, c = x.shape
+        num_unm = unm_pos.shape[1]
+        r = src_pos.shape[1]
+        t2 = t // 2
+
+        out = np.empty((n, num_unm + t2, c), dtype=x.dtype)
+
+        for b in numba.prange(n):
+            unm_rows, dst_rows = _output_rows(num_unm, t2, distill_token)
+
+            for j in range(t2):
+                out[b, dst_rows[j], :] = x[b, 2 * j + 1, :]
+
+            count = np.ones(t2, dtype=np.int64)
+            for k in range(r):
+                row = dst_rows[dst_idx[b, k]]
+                src = src_pos[b, k]
+                if mode == 2:
+                    for ch in range(c):
+                        out[b, row, ch] = max(out[b, row, ch], x[b, src, ch])
+                else:
+                    for ch in range(c):
+                        out[b, row, ch] += x[b, src, ch]
+                    count[dst_idx[b, k]] += 1
+
+            if mode == 1:
+                for j in range(t2):
+                    out[b, dst_rows[j], :] /= count[j]
+
+            for i in range(num_unm):
+                out[b, unm_rows[i], :] = x[b, unm_pos[b, i], :]
+
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def _bipartite_wavg_cpu(x, size, unm_pos, src_pos, dst_idx, distill_token):
+        n, t, c = x.shape
+        num_unm = unm_pos.shape[1]
+        r = src_pos.shape[1]
+        t2 = t // 2
+
+        out = np.empty((n, num_unm + t2, c), dtype=x.dtype)
+        out_size = np.empty((n, num_unm + t2, 1), dtype=size.dtype)
+
+        for b in numba.prange(n):
+            unm_rows, dst_rows = _output_rows(num_unm, t2, distill_token)
+
+            for j in range(t2):
+                row = dst_rows[j]
+                s = size[b, 2 * j + 1, 0]
+                out_size[b, row, 0] = s
+                for ch in range(c):
+                    out[b, row, ch] = x[b, 2 * j + 1, ch] * s
+
+            for k in range(r):
+                row = dst_rows[dst_idx[b, k]]
+                src = src_pos[b, k]
+                s = size[b, src, 0]
+                out_size[b, row, 0] += s
+                for ch in range(c):
+                    out[b, row, ch] += x[b, src, ch] * s
+
+            for j in range(t2):
+                row = dst_rows[j]
+                out[b, row, :] /= out_size[b, row, 0]
+
+            # Unmerged tokens pass through as is, no need to weight them
+            for i in range(num_unm):
+                out[b, unm_rows[i], :] = x[b, unm_pos[b, i], :]
+                out_size[b, unm_rows[i], 0] = size[b, unm_pos[b, i], 0]
+
+        return out, out_size
+
+
+def _cpu_kernel_supported(*tensors: torch.Tensor) -> bool:
+    return HAS_NUMBA and all(
+        x.device.type == "cpu"
+        and x.dtype in _CPU_MERGE_DTYPES
+        and not (torch.is_grad_enabled() and x.requires_grad)
+        for x in tensors
+    )
+
+
+def cpu_merge_supported(x: torch.Tensor, mode: str) -> bool:
+    """Whether bipartite_merge_cpu can handle this merge. It doesn't support autograd."""
+    return mode in _CPU_MERGE_MODES and _cpu_kernel_supported(x)
+
+
+def cpu_wavg_supported(x: torch.Tensor, size: torch.Tensor) -> bool:
+    """Whether bipartite_wavg_cpu can handle this weighted average. It doesn't support autograd."""
+    return x.dtype == size.dtype and _cpu_kernel_supported(x, size)
+
+
+def _to_numpy(x: torch.Tensor) -> "np.ndarray":
+    # Callers only get here without autograd, but x may still be marked as requiring grad
+    return x.detach().contiguous().numpy()
+
+
+def bipartite_merge_cpu(
+    x: torch.Tensor,
+    unm_pos: torch.Tensor,
+    src_pos: torch.Tensor,
+    dst_idx: torch.Tensor,
+    mode: str,
+    distill_token: bool,
+) -> torch.Tensor:
+    """
+    The merge from bipartite_soft_matching as a numba kernel that runs over the batch in parallel.
+    unm_pos and src_pos are the positions of the unmerged and merged even tokens in x, and dst_idx
+    the odd token each merged token goes into. Requires numba and a cpu tensor.
+    """
+    out = _bipartite_merge_cpu(
+        _to_numpy(x),
+        _to_numpy(unm_pos),
+        _to_numpy(src_pos),
+        _to_numpy(dst_idx),
+        _CPU_MERGE_MODES[mode],
+        distill_token,
+    )
+    return torch.from_numpy(out)
+
+
+def bipartite_wavg_cpu(
+    x: torch.Tensor,
+    size: torch.Tensor,
+    unm_pos: torch.Tensor,
+    src_pos: torch.Tensor,
+    dst_idx: torch.Tensor,
+    distill_token: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The weighted average merge_wavg does for bipartite_soft_matching, as a numba kernel.
+    Same arguments as bipartite_merge_cpu, plus the token sizes. Returns the merged x and sizes.
+    """
+    out, out_size = _bipartite_wavg_cpu(
+        _to_numpy(x),
+        _to_numpy(size),
+        _to_numpy(unm_pos),
+        _to_numpy(src_pos),
+        _to_numpy(dst_idx),
+        distill_token,
+    )
+    return torch.from_numpy(out), torch.from_numpy(out_size)
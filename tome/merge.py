@@ -5,16 +5,176 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
-import math
+import functools
 from typing import Callable, Tuple
 
 import torch
 
+from tome.kernels import (
+    HAS_TRITON,
+    bipartite_merge_cpu,
+    bipartite_wavg_cpu,
+    cpu_merge_supported,
+    cpu_wavg_supported,
+    fused_bipartite_max,
+    half_dtype,
+)
+from tome import utils
+from tome.utils import maybe_compile, nvtx_range
+
 
 def do_nothing(x, mode=None):
     return x
 
 
+@functools.lru_cache(maxsize=32)
+def _batch_offset(n: int, device: torch.device) -> torch.Tensor:
+    """Returns arange(n) as an [n, 1] column. Cached, since every block needs the same one."""
+    # Built outside inference mode, so a first call under inference_mode doesn't cache an
+    # inference tensor that later training steps can't save for backward.
+    with torch.inference_mode(False):
+        return torch.arange(n, device=device)[:, None]
+
+
+@functools.lru_cache(maxsize=32)
+def _odd_rows(n: int, t: int, device: torch.device) -> torch.Tensor:
+    """Returns the rows of the odd tokens when an [n, t, c] tensor is viewed as [n * t, c]."""
+    # index_select saves this for backward, so it can't be cached as an inference tensor
+    with torch.inference_mode(False):
+        rows = torch.arange(1, t, 2, device=device) + _batch_offset(n, device) * t
+        return rows.view(-1).to(torch.int32)
+
+
+def _masked_arange(mask: torch.Tensor, k: int) -> torch.Tensor:
+    """
+    For an [n, t] mask with exactly k True values per row, returns where they are as an [n, k] tensor.
+    Same as arange(t).masked_select(mask).view(n, k), but without waiting on the device for the
+    number of True values. That keeps the matching free of host syncs, so it can be captured in a cuda graph.
+    """
+    n, t = mask.shape
+    # Every True gets its slot from a running count, every False goes to a spare slot at the end
+    slot = torch.where(mask, mask.cumsum(dim=-1) - 1, k)
+    out = torch.empty(n, k + 1, dtype=torch.long, device=mask.device)
+    out.scatter_(1, slot, torch.arange(t, device=mask.device).expand(n, t))
+    return out[:, :k]
+
+
+_unmerge_pool = {}
+
+
+def _unmerge_buffer(
+    n: int, t: int, c: int, dtype: torch.dtype, device: torch.device
+) -> torch.Tensor:
+    """
+    Returns an [n, t, c] buffer for unmerge that is reused across calls with the same shape.
+    Two buffers are kept per shape and handed out in turn, so the previous result is still intact
+    while the next one is written. Each result gets overwritten two calls later, so only use this
+    when autograd is off and the result is consumed before then (always true within a ViT block).
+    """
+    # Buffers made in inference mode can't be written outside of it (and vice versa)
+    key = (n, t, c, dtype, device, torch.is_inference_mode_enabled())
+
+    if key not in _unmerge_pool:
+        # Drop buffers from a previous batch size so they don't pile up
+        if any(k[0] != n for k in _unmerge_pool):
+            _unmerge_pool.clear()
+        _unmerge_pool[key] = [
+            torch.empty(n, t, c, dtype=dtype, device=device) for _ in range(2)
+        ]
+
+    # Swap the two buffers and hand out the one that wasn't returned last time
+    buffers = _unmerge_pool[key]
+    buffers.reverse()
+    return buffers[0]
+
+
+def _concat(unm: torch.Tensor, dst: torch.Tensor, distill_token: bool) -> torch.Tensor:
+    if distill_token:
+        return torch.cat([unm[:, :1], dst[:, :1], unm[:, 1:], dst[:, 1:]], dim=1)
+    else:
+        return torch.cat([unm, dst], dim=1)
+
+
+@maybe_compile()
+def _bipartite_merge(
+    x: torch.Tensor,
+    unm_flat: torch.Tensor,
+    src_flat: torch.Tensor,
+    odd_flat: torch.Tensor,
+    dst_flat: torch.Tensor,
+    dst_idx: torch.Tensor,
+    r: int,
+    mode: str,
+    distill_token: bool,
+) -> torch.Tensor:
+    """
+    The merge of bipartite_soft_matching, given the indices from its matching.
+    When compiled, the token count (which shrinks every block), the batch size and r become dynamic
+    after they first change, so one graph covers every layer instead of one per layer.
+    """
+    n, t, c = x.shape
+    t2 = t // 2
+
+    x_flat = x.reshape(n * t, c)
+    unm = x_flat.index_select(0, unm_flat).view(n, -1, c)
+    src = x_flat.index_select(0, src_flat).view(n, r, c)
+    dst = x_flat.index_select(0, odd_flat)
+
+    if mode in ("sum", "mean"):
+        # index_add avoids broadcasting dst_idx to [n, r, c] like scatter_reduce needs
+        dst = dst.index_add_(0, dst_flat, src.view(n * r, c))
+        if mode == "mean":
+            count = dst.new_ones(n * t2, 1).index_add(0, dst_flat, dst.new_ones(n * r, 1))
+            dst = dst / count
+        dst = dst.view(n, t2, c)
+    else:
+        dst = dst.view(n, t2, c).scatter_reduce(
+            -2, dst_idx[..., None].expand(n, r, c), src, reduce=mode, include_self=True
+        )
+
+    return _concat(unm, dst, distill_token)
+
+
+@maybe_compile()
+def _bipartite_wavg(
+    x: torch.Tensor,
+    size: torch.Tensor,
+    unm_flat: torch.Tensor,
+    src_flat: torch.Tensor,
+    odd_flat: torch.Tensor,
+    dst_flat: torch.Tensor,
+    r: int,
+    distill_token: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    merge_wavg for bipartite_soft_matching, given the indices from its matching. Only the merged
+    tokens get weighted by size. Unmerged tokens would just be divided by their size again, so
+    x * size is never formed for them. Compiled the same way as _bipartite_merge.
+    """
+    n, t, c = x.shape
+    t2 = t // 2
+
+    x_flat = x.reshape(n * t, c)
+    size_flat = size.reshape(n * t, 1)
+
+    unm_len = t - t2 - r
+    unm = x_flat.index_select(0, unm_flat).view(n, unm_len, c)
+    unm_size = size_flat.index_select(0, unm_flat).view(n, unm_len, 1)
+
+    src_size = size_flat.index_select(0, src_flat)
+    src = x_flat.index_select(0, src_flat) * src_size
+
+    dst_size = size_flat.index_select(0, odd_flat)
+    dst = x_flat.index_select(0, odd_flat) * dst_size
+    dst_size = dst_size.index_add(0, dst_flat, src_size)
+    dst = dst.index_add_(0, dst_flat, src) / dst_size
+
+    return (
+        _concat(unm, dst.view(n, t2, c), distill_token),
+        _concat(unm_size, dst_size.view(n, t2, 1), distill_token),
+    )
+
+
 def bipartite_soft_matching(
     metric: torch.Tensor,
     r: int,
@@ -32,6 +192,13 @@ def bipartite_soft_matching(
      - distill_token: Whether or not there's also a distillation token.
 
     When enabled, the class token and distillation tokens won't get merged.
+
+    The merge (and the weighted average merge_wavg uses) is compiled with torch.compile when
+    tome.utils._TOME_COMPILE is set. Expect two compiles per function: a static one for the first
+    layer, and a dynamic one that the remaining layers and batch sizes share.
+    If tome.utils._TOME_REUSE_BUFFERS is set, unmerge returns one of two shared output buffers when
+    autograd is off. That result is overwritten two unmerge calls later, from any layer, so clone it
+    if you need to keep it around (e.g., collecting unmerged features from several layers).
     """
     protected = 0
     if class_token:
@@ -46,102 +213,140 @@ def bipartite_soft_matching(
     if r <= 0:
         return do_nothing, do_nothing
 
-    with torch.no_grad():
-        torch.cuda.nvtx.range_push("Normalization")
-        metric = metric / metric.norm(dim=-1, keepdim=True)
-        torch.cuda.nvtx.range_pop()
+    # The class token (first even token) and distillation token (first odd token) are left out of
+    # the matching entirely, rather than scored and then masked out with -inf.
+    n = metric.shape[0]
+    t1, t2 = (t + 1) // 2, t // 2
+    a_off, b_off = int(class_token), int(distill_token)
 
-        torch.cuda.nvtx.range_push("AssignTokensToSets")
-        a, b = metric[..., ::2, :], metric[..., 1::2, :]
-        torch.cuda.nvtx.range_pop()
+    with torch.no_grad():
+        with nvtx_range("SimilarityScores"):
+            if HAS_TRITON and metric.is_cuda:
+                # Scores, max and argmax in one pass over metric, without writing out the scores
+                node_max, node_idx = fused_bipartite_max(metric, a_off, b_off)
+            else:
+                metric = metric / metric.norm(dim=-1, keepdim=True)
+                if metric.is_cuda:
+                    # Scores are only compared, so the matmul can run in 16 bit on tensor cores
+                    metric = metric.to(half_dtype(metric.device))
+                a, b = metric[..., 2 * a_off :: 2, :], metric[..., 2 * b_off + 1 :: 2, :]
+                scores = a @ b.transpose(-1, -2)
+                node_max, node_idx = scores.max(dim=-1)
+
+        with nvtx_range("ChooseKeepTokens"):
+            with nvtx_range("torch.topk()"):
+                # Only the identity of the top r edges matters, not their order
+                src_idx = node_max.topk(r, dim=-1, sorted=False)[1]
+
+            with nvtx_range("torch.gather()"):
+                dst_idx = node_idx.gather(dim=-1, index=src_idx) + b_off
+            src_idx = src_idx + a_off  # Merged Tokens
+
+            with nvtx_range("Unmerged_tokens_mask"):
+                unm_mask = torch.ones(n, t1, dtype=torch.bool, device=node_max.device)
+                unm_mask.scatter_(-1, src_idx, False)
+                # Unmerged tokens stay in their original order, so the class token remains at the start
+                unm_idx = _masked_arange(unm_mask, t1 - r)  # Unmerged Tokens
+
+            # Flattened indices for index_select / index_add on tensors viewed as [batch * tokens, channels].
+            # Indexing rows directly is cheaper than gather with an index expanded along the channels.
+            # Both ops take int32 indices, which halves the index bytes they read (gather and scatter
+            # need int64, so the unflattened indices stay int64).
+            offset = _batch_offset(n, metric.device)
+            unm_pos, src_pos = 2 * unm_idx, 2 * src_idx  # Positions of the even tokens in x
+            unm_flat = (unm_pos + offset * t).view(-1).to(torch.int32)
+            src_flat = (src_pos + offset * t).view(-1).to(torch.int32)
+            dst_flat = (dst_idx + offset * t2).view(-1).to(torch.int32)
+            # Pulling the odd tokens out this way gives a contiguous dst instead of a strided view
+            odd_flat = _odd_rows(n, t, metric.device)
+
+    def concat(unm: torch.Tensor, dst: torch.Tensor) -> torch.Tensor:
+        return _concat(unm, dst, distill_token)
 
-        torch.cuda.nvtx.range_push("SimilarityScores")
-        scores = a @ b.transpose(-1, -2)
-        torch.cuda.nvtx.range_pop()
+    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
+        if cpu_merge_supported(x, mode):
+            return bipartite_merge_cpu(x, unm_pos, src_pos, dst_idx, mode, distill_token)
 
-        if class_token:
-            scores[..., 0, :] = -math.inf
-        if distill_token:
-            scores[..., :, 0] = -math.inf
+        return _bipartite_merge(
+            x, unm_flat, src_flat, odd_flat, dst_flat, dst_idx, r, mode, distill_token
+        )
 
-        torch.cuda.nvtx.range_push("ChooseKeepTokens")
+    def wavg(x: torch.Tensor, size: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if cpu_wavg_supported(x, size):
+            return bipartite_wavg_cpu(x, size, unm_pos, src_pos, dst_idx, distill_token)
 
-        torch.cuda.nvtx.range_push("torch.max()")
-        node_max, node_idx = scores.max(dim=-1)
-        torch.cuda.nvtx.range_pop()
+        return _bipartite_wavg(
+            x, size, unm_flat, src_flat, odd_flat, dst_flat, r, distill_token
+        )
 
-        torch.cuda.nvtx.range_push("node_max.argsort()")
-        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
-        torch.cuda.nvtx.range_pop()
+    unm_len = t1 - r
+    unmerge_rows = None
 
-        torch.cuda.nvtx.range_push("Unmerged_tokens_slice")
-        unm_idx = edge_idx[..., r:, :]  # Unmerged Tokens
-        torch.cuda.nvtx.range_pop()
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        nonlocal unmerge_rows
+        n, _, c = x.shape
+        device = x.device
+
+        if unmerge_rows is None:
+            # For every output token, find the row of x it comes from. Odd tokens are dst, unmerged
+            # even tokens are their own row, and merged even tokens copy the dst they went into.
+            # Every output token gets written exactly once, so nothing has to be zeroed first.
+            rows = torch.empty(n, t, dtype=torch.long, device=device)
+            rows[:, 1::2] = unm_len + torch.arange(t2, device=device)
+            rows.scatter_(1, unm_pos, torch.arange(unm_len, device=device).expand(n, -1))
+            rows.scatter_(1, src_pos, unm_len + dst_idx)
+            unmerge_rows = (rows + offset * (unm_len + t2)).view(-1).to(torch.int32)
+        rows = unmerge_rows
+
+        x_flat = x.reshape(n * (unm_len + t2), c)
+        if torch.is_grad_enabled() or not utils._TOME_REUSE_BUFFERS:
+            return x_flat.index_select(0, rows).view(n, t, c)
+
+        out = _unmerge_buffer(n, t, c, x.dtype, device)
+        torch.index_select(x_flat, 0, rows, out=out.view(n * t, c))
+        return out
 
-        torch.cuda.nvtx.range_push("Merged_tokens_slice")
-        src_idx = edge_idx[..., :r, :]  # Merged Tokens
-        torch.cuda.nvtx.range_pop()
+    def initial_source(device: torch.device) -> torch.Tensor:
+        # Same as merge(eye(t), mode="amax"), but without building the identity. Every row marks
+        # the token it came from, and merged dst rows also mark each src merged into them.
+        unm = torch.zeros(n, unm_len, t, dtype=torch.uint8, device=device)
+        unm.scatter_(2, unm_pos[..., None], 1)
 
-        torch.cuda.nvtx.range_push("torch.gather()")
-        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
-        torch.cuda.nvtx.range_pop()
+        dst = torch.zeros(n, t2, t, dtype=torch.uint8, device=device)
+        dst_rows = dst.view(n, t2 * t)
+        dst_rows[:, 1 :: t + 2] = 1  # dst token j is token 2 * j + 1
+        dst_rows.scatter_(1, dst_idx * t + src_pos, 1)
 
-        torch.cuda.nvtx.range_push("sort_unmerged_tokens")
-        if class_token:
-            # Sort to ensure the class token is at the start
-            #torch.cuda.nvtx.range_push("sort_unmerged_tokens")
-            unm_idx = unm_idx.sort(dim=1)[0]
-            #torch.cuda.nvtx.range_pop()
-        torch.cuda.nvtx.range_pop()
+        return concat(unm, dst)
 
-        torch.cuda.nvtx.range_pop()
+    # Lets merge_wavg and merge_source use the fused versions above
+    merge.wavg = wavg
+    merge.initial_source = initial_source
 
-    def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-        #torch.cuda.nvtx.range_push("merge")
-        src, dst = x[..., ::2, :], x[..., 1::2, :]
-        n, t1, c = src.shape
-
-        #torch.cuda.nvtx.range_push("torch.gather()")
-        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
-        #torch.cuda.nvtx.range_pop()
-
-        #torch.cuda.nvtx.range_push("torch.gather()")
-        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
-        #torch.cuda.nvtx.range_pop()
-
-        #torch.cuda.nvtx.range_push("torch.scatter_reduce()")
-        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
-        #torch.cuda.nvtx.range_pop()
-
-        #torch.cuda.nvtx.range_pop()
-
-        #torch.cuda.nvtx.range_push("concatenate")
-        if distill_token:
-            #torch.cuda.nvtx.range_push("concatenate")
-            return torch.cat([unm[:, :1], dst[:, :1], unm[:, 1:], dst[:, 1:]], dim=1)
-            #torch.cuda.nvtx.range_pop()
-        else:
-            #torch.cuda.nvtx.range_push("concatenate")
-            return torch.cat([unm, dst], dim=1)
-            #torch.cuda.nvtx.range_pop()
-        #torch.cuda.nvtx.range_pop()
+    return merge, unmerge
 
-    def unmerge(x: torch.Tensor) -> torch.Tensor:
-        unm_len = unm_idx.shape[1]
-        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
-        n, _, c = unm.shape
 
-        src = dst.gather(dim=-2, index=dst_idx.expand(n, r, c))
+def _kth_split(x: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    t_rnd = (x.shape[1] // k) * k
+    x = x[:, :t_rnd, :].view(x.shape[0], -1, k, x.shape[2])
+    a = x[:, :, : (k - 1), :].reshape(x.shape[0], -1, x.shape[-1])
+    b = x[:, :, (k - 1), :]
+    return a, b
 
-        out = torch.zeros(n, metric.shape[1], c, device=x.device, dtype=x.dtype)
 
-        out[..., 1::2, :] = dst
-        out.scatter_(dim=-2, index=(2 * unm_idx).expand(n, unm_len, c), src=unm)
-        out.scatter_(dim=-2, index=(2 * src_idx).expand(n, r, c), src=src)
+@maybe_compile(mode="max-autotune")
+def _kth_match(metric: torch.Tensor, k: int) -> torch.Tensor:
+    metric = metric / metric.norm(dim=-1, keepdim=True)
+    a, b = _kth_split(metric, k)
+    scores = a @ b.transpose(-1, -2)
+    return scores.argmax(dim=-1)
 
-        return out
 
-    return merge, unmerge
+@maybe_compile(mode="max-autotune")
+def _kth_merge(x: torch.Tensor, dst_idx: torch.Tensor, k: int, mode: str) -> torch.Tensor:
+    src, dst = _kth_split(x, k)
+    n, r, c = src.shape
+    return dst.scatter_reduce(-2, dst_idx[..., None].expand(n, r, c), src, reduce=mode)
 
 
 def kth_bipartite_soft_matching(
@@ -154,40 +359,24 @@ def kth_bipartite_soft_matching(
     Input size is [batch, tokens, channels].
     z indicates the stride for the first set.
     z = 2 is equivalent to regular bipartite_soft_matching with r = 0.5 * N
+
+    The matching and merge are compiled with torch.compile when tome.utils._TOME_COMPILE is set.
     """
     if k <= 1:
         return do_nothing, do_nothing
 
-    def split(x):
-        t_rnd = (x.shape[1] // k) * k
-        x = x[:, :t_rnd, :].view(x.shape[0], -1, k, x.shape[2])
-        a, b = (
-            x[:, :, : (k - 1), :].contiguous().view(x.shape[0], -1, x.shape[-1]),
-            x[:, :, (k - 1), :],
-        )
-        return a, b
-
     with torch.no_grad():
-        metric = metric / metric.norm(dim=-1, keepdim=True)
-        a, b = split(metric)
-        r = a.shape[1]
-        scores = a @ b.transpose(-1, -2)
-
-        _, dst_idx = scores.max(dim=-1)
-        dst_idx = dst_idx[..., None]
+        dst_idx = _kth_match(metric, k)
+        r = dst_idx.shape[1]
 
     def merge(x: torch.Tensor, mode="mean") -> torch.Tensor:
-        src, dst = split(x)
-        n, _, c = src.shape
-        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
-
-        return dst
+        return _kth_merge(x, dst_idx, k, mode)
 
     def unmerge(x: torch.Tensor) -> torch.Tensor:
         n, _, c = x.shape
         dst = x
 
-        src = dst.gather(dim=-2, index=dst_idx.expand(n, r, c)).to(x.dtype)
+        src = dst.gather(dim=-2, index=dst_idx[..., None].expand(n, r, c)).to(x.dtype)
 
         src = src.view(n, -1, (k - 1), c)
         dst = dst.view(n, -1, 1, c)
@@ -214,10 +403,15 @@ def random_bipartite_soft_matching(
 
     with torch.no_grad():
         B, N, _ = metric.shape
-        rand_idx = torch.rand(B, N, 1, device=metric.device).argsort(dim=1)
+        # A random partition only needs r random picks, not a full random permutation
+        a_idx = torch.rand(B, N, device=metric.device).topk(r, dim=1, sorted=False)[1]
+
+        b_mask = torch.ones(B, N, dtype=torch.bool, device=metric.device)
+        b_mask.scatter_(1, a_idx, False)
+        b_idx = _masked_arange(b_mask, N - r)
 
-        a_idx = rand_idx[:, :r, :]
-        b_idx = rand_idx[:, r:, :]
+        a_idx = a_idx[..., None]
+        b_idx = b_idx[..., None]
 
         def split(x):
             C = x.shape[-1]
@@ -264,6 +458,9 @@ def merge_wavg(
     if size is None:
         size = torch.ones_like(x[..., 0, None])
 
+    if hasattr(merge, "wavg"):
+        return merge.wavg(x, size)
+
     x = merge(x * size, mode="sum")
     size = merge(size, mode="sum")
 
@@ -277,10 +474,14 @@ def merge_source(
     """
     For source tracking. Source is an adjacency matrix between the initial tokens and final merged groups.
     x is used to find out how many tokens there are in case the source is None.
+    Source is stored as uint8, since it only ever holds 0s and 1s.
     """
     if source is None:
+        if hasattr(merge, "initial_source"):
+            return merge.initial_source(x.device)
+
         n, t, _ = x.shape
-        source = torch.eye(t, device=x.device)[None, ...].expand(n, t, t)
+        source = torch.eye(t, device=x.device, dtype=torch.uint8)[None, ...].expand(n, t, t)
 
     source = merge(source, mode="amax")
     return source
@@ -15,7 +15,7 @@ import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 import tlt.models
 from tome.merge import bipartite_soft_matching, merge_source, merge_wavg
-from tome.utils import parse_r
+from tome.utils import nvtx_range, parse_r
 
 
 class ToMeBlock(Block):
@@ -39,27 +39,25 @@ class ToMeBlock(Block):
 
         r = self._tome_info["r"].pop(0)
         if r > 0:
-            torch.cuda.nvtx.range_push("TokenMerging")
-
-            # Apply ToMe here
-            torch.cuda.nvtx.range_push("BipartiteSoftMatching")
-            merge, _ = bipartite_soft_matching(
-                metric,
-                r,
-                self._tome_info["class_token"],
-                self._tome_info["distill_token"],
-            )
-            torch.cuda.nvtx.range_pop()
-
-            if self._tome_info["trace_source"]:
-                self._tome_info["source"] = merge_source(
-                    merge, x, self._tome_info["source"]
-                )
-            torch.cuda.nvtx.range_push("MergeTokens_ConcatSets")
-            x, self._tome_info["size"] = merge_wavg(merge, x, self._tome_info["size"])
-            torch.cuda.nvtx.range_pop()
-
-            torch.cuda.nvtx.range_pop()
+            with nvtx_range("TokenMerging"):
+                # Apply ToMe here
+                with nvtx_range("BipartiteSoftMatching"):
+                    merge, _ = bipartite_soft_matching(
+                        metric,
+                        r,
+                        self._tome_info["class_token"],
+                        self._tome_info["distill_token"],
+                    )
+
+                if self._tome_info["trace_source"]:
+                    self._tome_info["source"] = merge_source(
+                        merge, x, self._tome_info["source"]
+                    )
+
+                with nvtx_range("MergeTokens_ConcatSets"):
+                    x, self._tome_info["size"] = merge_wavg(
+                        merge, x, self._tome_info["size"]
+                    )
 
         x = x + self._drop_path2(self.mlp(self.norm2(x)))
         return x
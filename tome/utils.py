@@ -5,12 +5,66 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
+import contextlib
+import functools
 import time
-from typing import List, Tuple, Union
+from typing import Callable, List, Tuple, Union
 
 import torch
 from tqdm import tqdm
 
+# Set to True to emit nvtx ranges around the ToMe ops (e.g., for nsight systems).
+_TOME_PROFILE = False
+
+
+def nvtx_range(name: str):
+    """
+    Context manager that marks an nvtx range if _TOME_PROFILE is set, and does nothing otherwise.
+    This keeps the cuda api calls out of the hot path (and out of cuda graph capture) by default.
+    """
+    if _TOME_PROFILE:
+        return torch.cuda.nvtx.range(name)
+    return contextlib.nullcontext()
+
+
+# Set to True to run the functions wrapped with maybe_compile through torch.compile.
+_TOME_COMPILE = False
+
+# Set to True to let unmerge write into reused output buffers when autograd is off.
+# The result of unmerge then gets overwritten two unmerge calls later (from any layer).
+_TOME_REUSE_BUFFERS = False
+
+
+def maybe_compile(**compile_kwargs) -> Callable:
+    """
+    Decorator that runs the function through torch.compile if _TOME_COMPILE is set.
+    The function is compiled on the first call with the flag on. Otherwise, or on pytorch versions
+    without torch.compile, the function runs eagerly as is.
+
+    Shapes are left to torch.compile's automatic dynamic shapes: the first call compiles with static
+    shapes and any size that changes after that is recompiled once as dynamic. The token count shrinks
+    in every block, so static shapes would recompile for each layer (and batch size) until dynamo hits
+    its recompile limit and silently runs the rest eagerly.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        compiled = None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwdargs):
+            nonlocal compiled
+
+            if not _TOME_COMPILE or not hasattr(torch, "compile"):
+                return fn(*args, **kwdargs)
+
+            if compiled is None:
+                compiled = torch.compile(fn, **compile_kwargs)
+            return compiled(*args, **kwdargs)
+
+        return wrapper
+
+    return decorator
+
 
 def benchmark(
     model: torch.nn.Module,
@@ -20,6 +74,7 @@ def benchmark(
     runs: int = 40,
     throw_out: float = 0.25,
     use_fp16: bool = False,
+    use_cuda_graph: bool = False,
     verbose: bool = False,
 ) -> float:
     """
@@ -33,6 +88,7 @@ def benchmark(
      - runs: the number of total runs to do
      - throw_out: the percentage of runs to throw out at the start of testing
      - use_fp16: whether or not to benchmark with float16 and autocast
+     - use_cuda_graph: whether or not to capture the forward pass in a cuda graph and replay it
      - verbose: whether or not to use tqdm to print progress / print throughput at end
 
     Returns:
@@ -53,6 +109,12 @@ def benchmark(
 
     with torch.autocast(device.type, enabled=use_fp16):
         with torch.no_grad():
+            def forward():
+                return model(input)
+
+            if use_cuda_graph and is_cuda:
+                forward = capture_cuda_graph(forward)
+
             for i in tqdm(range(runs), disable=not verbose, desc="Benchmarking"):
                 if i == warm_up:
                     if is_cuda:
@@ -60,7 +122,7 @@ def benchmark(
                     total = 0
                     start = time.time()
 
-                model(input)
+                forward()
                 time.sleep(0.5)
                 total += batch_size
 
@@ -78,6 +140,29 @@ def benchmark(
     return throughput
 
 
+def capture_cuda_graph(fn: Callable, warm_up: int = 3) -> Callable:
+    """
+    Captures fn (which takes no arguments) in a cuda graph and returns a function that replays it.
+    Inputs and outputs are whatever tensors fn reads and writes, so update those in place between replays.
+
+    ToMe rebuilds its merge functions every forward pass, so capture the whole model forward rather than
+    the individual merges. The matching itself doesn't sync with the host, so it's safe to capture.
+    """
+    # Warm up on a side stream so lazy initialization (cublas, triton, cached buffers) stays out of the graph
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warm_up):
+            fn()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        fn()
+
+    return graph.replay
+
+
 def parse_r(num_layers: int, r: Union[List[int], Tuple[int, float], int]) -> List[int]:
     """
     Process a constant r or r schedule into a list for use internally.